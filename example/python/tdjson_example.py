@@ -8,8 +8,36 @@
 from ctypes.util import find_library
 from ctypes import *
 import json
+import os
 import sys
 
+# use a faster JSON implementation if available
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        def json_dumps(query):
+            return ujson.dumps(query, ensure_ascii=False).encode('utf-8')
+    except ImportError:
+        # reuse a single encoder producing compact JSON without escaping of non-ASCII characters
+        json_encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+        def json_dumps(query):
+            return json_encode(query).encode('utf-8')
+
+    try:
+        import simdjson
+
+        json_loads = simdjson.loads
+    except ImportError:
+        # json.loads accepts UTF-8 encoded bytes directly
+        json_loads = json.loads
+
 # load shared library
 tdjson_path = find_library('tdjson') or 'tdjson.dll'
 if tdjson_path is None:
@@ -40,98 +68,137 @@ _td_set_log_message_callback = tdjson.td_set_log_message_callback
 _td_set_log_message_callback.restype = None
 _td_set_log_message_callback.argtypes = [c_int, log_message_callback_type]
 
+# the type of a TDLib object is serialized before its other fields
+update_authorization_state_prefix = b'{"@type":"updateAuthorizationState"'
+
+# serialize constant queries only once
+get_authorization_state_query = json_dumps({'@type': 'getAuthorizationState', '@extra': 1.01234})
+check_database_encryption_key_query = json_dumps({'@type': 'checkDatabaseEncryptionKey', 'encryption_key': ''})
+
+# you MUST obtain your own api_id and api_hash at https://my.telegram.org
+# and use them in the setTdlibParameters call
+set_tdlib_parameters_query = json_dumps({'@type': 'setTdlibParameters', 'parameters': {
+                                           'database_directory': 'tdlib',
+                                           'use_message_database': True,
+                                           'use_secret_chats': True,
+                                           'api_id': 94575,
+                                           'api_hash': 'a3406de8d171bb422bb6ddf3bbd800e2',
+                                           'system_language_code': 'en',
+                                           'device_model': 'Desktop',
+                                           'application_version': '1.0',
+                                           'enable_storage_optimizer': True}})
+
 # initialize TDLib log with desired parameters
 def on_log_message_callback(verbosity_level, message):
-    if verbosity_level == 0:
-        print('TDLib fatal error: ', message)
-        sys.stdout.flush()
+    print('TDLib fatal error: ', message)
+    sys.stdout.flush()
 
 def td_execute(query):
-    query = json.dumps(query).encode('utf-8')
-    result = _td_execute(query)
+    result = _td_execute(json_dumps(query))
     if result:
-        result = json.loads(result.decode('utf-8'))
+        result = json_loads(result)
     return result
 
 c_on_log_message_callback = log_message_callback_type(on_log_message_callback)
-_td_set_log_message_callback(2, c_on_log_message_callback)
+# the callback is called only for fatal errors, so other log messages don't need to be passed to Python
+_td_set_log_message_callback(0, c_on_log_message_callback)
 
 # setting TDLib log verbosity level to 1 (errors)
-print(str(td_execute({'@type': 'setLogVerbosityLevel', 'new_verbosity_level': 1, '@extra': 1.01234})).encode('utf-8'))
+result = td_execute({'@type': 'setLogVerbosityLevel', 'new_verbosity_level': 1, '@extra': 1.01234})
+print(json_dumps(result).decode('utf-8'))
 
 
 # create client
 client_id = _td_create_client_id()
 
-# simple wrappers for client usage
+# simple wrapper for client usage; events are received in the main events cycle
 def td_send(query):
-    query = json.dumps(query).encode('utf-8')
-    _td_send(client_id, query)
-
-def td_receive():
-    result = _td_receive(1.0)
-    if result:
-        result = json.loads(result.decode('utf-8'))
-    return result
+    _td_send(client_id, json_dumps(query))
 
 # another test for TDLib execute method
-print(str(td_execute({'@type': 'getTextEntities', 'text': '@telegram /test_command https://telegram.org telegram.me', '@extra': ['5', 7.0, 'ä']})).encode('utf-8'))
+result = td_execute({'@type': 'getTextEntities', 'text': '@telegram /test_command https://telegram.org telegram.me', '@extra': ['5', 7.0, 'ä']})
+print(json_dumps(result).decode('utf-8'))
+
+# authorization state handlers
+
+# use the value of the environment variable if it is set to avoid blocking on user input
+def get_input(environment_variable, prompt):
+    value = os.environ.get(environment_variable)
+    if value is None:
+        value = input(prompt)
+    return value
+
+# set TDLib parameters
+def on_wait_tdlib_parameters(auth_state):
+    _td_send(client_id, set_tdlib_parameters_query)
+
+# set an encryption key for database to let know TDLib how to open the database
+def on_wait_encryption_key(auth_state):
+    _td_send(client_id, check_database_encryption_key_query)
+
+# enter phone number to log in
+def on_wait_phone_number(auth_state):
+    phone_number = get_input('TG_PHONE', 'Please enter your phone number: ')
+    td_send({'@type': 'setAuthenticationPhoneNumber', 'phone_number': phone_number})
+
+# the authentication code is sent only after the phone number is set, so it can't be known in advance;
+# replace this function to receive the code from another source, for example, from a bot or a test
+def get_authentication_code(auth_state):
+    return get_input('TG_CODE', 'Please enter the authentication code you received: ')
+
+# wait for authorization code
+def on_wait_code(auth_state):
+    code = get_authentication_code(auth_state)
+    td_send({'@type': 'checkAuthenticationCode', 'code': code})
+
+# wait for first and last name for new users
+def on_wait_registration(auth_state):
+    first_name = get_input('TG_FIRST_NAME', 'Please enter your first name: ')
+    last_name = get_input('TG_LAST_NAME', 'Please enter your last name: ')
+    td_send({'@type': 'registerUser', 'first_name': first_name, 'last_name': last_name})
+
+# wait for password if present
+def on_wait_password(auth_state):
+    password = get_input('TG_PASSWORD', 'Please enter your password: ')
+    td_send({'@type': 'checkAuthenticationPassword', 'password': password})
+
+auth_state_handlers = {
+    'authorizationStateWaitTdlibParameters': on_wait_tdlib_parameters,
+    'authorizationStateWaitEncryptionKey': on_wait_encryption_key,
+    'authorizationStateWaitPhoneNumber': on_wait_phone_number,
+    'authorizationStateWaitCode': on_wait_code,
+    'authorizationStateWaitRegistration': on_wait_registration,
+    'authorizationStateWaitPassword': on_wait_password,
+}
 
 # start the client by sending request to it
-td_send({'@type': 'getAuthorizationState', '@extra': 1.01234})
+_td_send(client_id, get_authorization_state_query)
 
 # main events cycle
-while True:
-    event = td_receive()
-    if event:
-        # process authorization states
-        if event['@type'] == 'updateAuthorizationState':
-            auth_state = event['authorization_state']
-
-            # if client is closed, we need to destroy it and create new client
-            if auth_state['@type'] == 'authorizationStateClosed':
-                break
-
-            # set TDLib parameters
-            # you MUST obtain your own api_id and api_hash at https://my.telegram.org
-            # and use them in the setTdlibParameters call
-            if auth_state['@type'] == 'authorizationStateWaitTdlibParameters':
-                td_send({'@type': 'setTdlibParameters', 'parameters': {
-                                                       'database_directory': 'tdlib',
-                                                       'use_message_database': True,
-                                                       'use_secret_chats': True,
-                                                       'api_id': 94575,
-                                                       'api_hash': 'a3406de8d171bb422bb6ddf3bbd800e2',
-                                                       'system_language_code': 'en',
-                                                       'device_model': 'Desktop',
-                                                       'application_version': '1.0',
-                                                       'enable_storage_optimizer': True}})
-
-            # set an encryption key for database to let know TDLib how to open the database
-            if auth_state['@type'] == 'authorizationStateWaitEncryptionKey':
-                td_send({'@type': 'checkDatabaseEncryptionKey', 'encryption_key': ''})
-
-            # enter phone number to log in
-            if auth_state['@type'] == 'authorizationStateWaitPhoneNumber':
-                phone_number = input('Please enter your phone number: ')
-                td_send({'@type': 'setAuthenticationPhoneNumber', 'phone_number': phone_number})
-
-            # wait for authorization code
-            if auth_state['@type'] == 'authorizationStateWaitCode':
-                code = input('Please enter the authentication code you received: ')
-                td_send({'@type': 'checkAuthenticationCode', 'code': code})
-
-            # wait for first and last name for new users
-            if auth_state['@type'] == 'authorizationStateWaitRegistration':
-                first_name = input('Please enter your first name: ')
-                last_name = input('Please enter your last name: ')
-                td_send({'@type': 'registerUser', 'first_name': first_name, 'last_name': last_name})
-
-            # wait for password if present
-            if auth_state['@type'] == 'authorizationStateWaitPassword':
-                password = input('Please enter your password: ')
-                td_send({'@type': 'checkAuthenticationPassword', 'password': password})
-
-        # handle an incoming update or an answer to a previously sent request
-        print(str(event).encode('utf-8'))
-        sys.stdout.flush()
+# functions used for every event are bound to default arguments to be accessed as local variables
+def process_events(receive=_td_receive, auth_state_prefix=update_authorization_state_prefix, loads=json_loads,
+                   get_auth_state_handler=auth_state_handlers.get,
+                   write=sys.stdout.buffer.write, flush=sys.stdout.buffer.flush):
+    # events are written directly to the binary stdout buffer, so text written before must go first
+    sys.stdout.flush()
+    while True:
+        result = receive(1.0)
+        if result:
+            # process authorization states; other events aren't parsed, because they are only printed
+            if result.startswith(auth_state_prefix):
+                auth_state = loads(result)['authorization_state']
+
+                # if client is closed, we need to destroy it and create new client
+                if auth_state['@type'] == 'authorizationStateClosed':
+                    break
+
+                handler = get_auth_state_handler(auth_state['@type'])
+                if handler:
+                    handler(auth_state)
+
+            # handle an incoming update or an answer to a previously sent request
+            write(result)
+            write(b'\n')
+            flush()
+
+process_events()